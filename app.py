@@ -1,83 +1,391 @@
 import os
+import io
+import re
+import asyncio
 import datetime
+import hashlib
+import shelve
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
+import pypdfium2 as pdfium
 from PyPDF2 import PdfReader
 from docx import Document
+from docx.oxml.ns import nsmap, qn
+from lxml import etree
+import numpy as np
+try:
+    # Optional: compiles the retrieval scoring scan to parallel native code
+    import numba
+except ImportError:
+    numba = None
 import streamlit as st
 
-# Load environment variables from .env file
-load_dotenv()
-
 # ========== STEP 1: Setup API Key ==========
-API_KEY = os.environ.get("GEMINI_API_KEY")
+
+# Streamlit re-executes this script on every interaction, so SDK setup is done
+# once per process and reused by later reruns.
+@st.cache_resource
+def configure_gemini():
+    """Loads the .env file, configures the Gemini SDK and returns the API key."""
+    # Load environment variables from .env file
+    load_dotenv()
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if api_key:
+        genai.configure(api_key=api_key)
+    return api_key
+
+API_KEY = configure_gemini()
 if not API_KEY:
+    # Do not cache the missing key, so the next rerun checks again
+    configure_gemini.clear()
     st.error("Please set the GEMINI_API_KEY environment variable.")
     st.stop()
 
-genai.configure(api_key=API_KEY)
 MODEL_RESOURCE_NAME = "models/gemini-1.5-pro-001"
 
+# Explicit context caching settings. Gemini refuses to cache contexts smaller
+# than the model's minimum, so smaller documents are sent inline instead.
+CACHE_TTL = datetime.timedelta(hours=1)
+CACHE_MIN_TOKENS = {
+    "models/gemini-1.5-pro-001": 32768,
+    "models/gemini-1.5-pro-002": 32768,
+    "models/gemini-1.5-flash-001": 32768,
+    "models/gemini-1.5-flash-002": 32768,
+}
+DEFAULT_CACHE_MIN_TOKENS = 4096
+
+# Cache names are persisted here so a restarted app reuses still-live caches.
+# Caches that chats keep using get their TTL renewed every CACHE_REFRESH_INTERVAL.
+CACHE_INDEX_PATH = ".cag_cache_index"
+CACHE_REFRESH_INTERVAL = CACHE_TTL / 2
+
+# Answering rules shared by the full-document and retrieval prompts. They are
+# language-neutral so switching the UI language keeps the cached prefix; the
+# answer language comes from LANGUAGE_DIRECTIVE, appended to every question.
+SYSTEM_INSTRUCTIONS = (
+    "You are a helpful assistant. "
+    "Your primary function is to answer user questions strictly based on the "
+    "information contained in the provided document context. "
+    "If the answer to a question cannot be found within the provided documents, "
+    "you MUST explicitly state: 'The information is not available in the provided documents.' "
+    "Do not attempt to answer from general knowledge if the information is not in the documents. "
+    "Each question ends with the language to answer in."
+)
+
+LANGUAGE_DIRECTIVE = {
+    "मराठी": (
+        "Answer in Marathi (तुम्ही मराठी भाषेत उत्तर द्या). If the information is not in the documents, "
+        "say: 'ही माहिती प्रदान केलेल्या दस्तऐवजांमध्ये उपलब्ध नाही.'"
+    ),
+    "English": "Answer in English.",
+}
+
+# System prompt with the document embedded between fixed markers.
+# This is the cached prefix of every request, so it must render byte-identical
+# for the same document: never add timestamps or other per-turn values here.
+SYSTEM_PROMPT_TEMPLATE = SYSTEM_INSTRUCTIONS + (
+    "\n\n"
+    "DOCUMENT CONTENT START\n\n"
+    "{document_content}\n\n"
+    "DOCUMENT CONTENT END\n\n"
+    "Use ONLY the information between DOCUMENT CONTENT START and DOCUMENT CONTENT END "
+    "to answer questions. If the information is not in the document, say so."
+)
+
+# Retrieval mode sends only the chunks most similar to each question instead of
+# the whole document, so the system prompt carries the rules alone.
+EMBEDDING_MODEL = "models/text-embedding-004"
+EMBED_BATCH_SIZE = 100
+CHUNK_SIZE = 1500
+RETRIEVAL_TOP_K = 8
+RERANK_CANDIDATES = 100
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?।])\s+|\n{2,}")
+
+RETRIEVAL_SYSTEM_PROMPT = SYSTEM_INSTRUCTIONS + (
+    "\n\n"
+    "Each question comes with the relevant document excerpts between DOCUMENT EXCERPTS START "
+    "and DOCUMENT EXCERPTS END. Use ONLY the information in those excerpts to answer."
+)
+
+RETRIEVAL_QUESTION_TEMPLATE = "DOCUMENT EXCERPTS START\n\n{excerpts}\n\nDOCUMENT EXCERPTS END\n\nQuestion: {question}"
+
+# Streaming replies redraw at most every STREAM_FLUSH_SECONDS, or sooner once
+# STREAM_FLUSH_CHARS new characters have arrived.
+STREAM_FLUSH_SECONDS = 0.05
+STREAM_FLUSH_CHARS = 200
+
+# PDF extraction drops running headers and footers: lines in the first or last
+# HEADER_FOOTER_LINES lines of a page that recur in that band on at least
+# HEADER_FOOTER_MIN_PAGES pages. The first occurrence is kept. DOCX drops a
+# paragraph only when it repeats its previous sibling. Blocks shorter than
+# DEDUP_MIN_CHARS, such as table values, are always kept.
+HEADER_FOOTER_LINES = 3
+HEADER_FOOTER_MIN_PAGES = 3
+DEDUP_MIN_CHARS = 20
+
 # ========== STEP 2: Document Extraction ==========
 
-def extract_text_from_pdf(pdf_file):
-    """Extracts text from all pages of a PDF file."""
+def text_digest(text):
+    """Hashes text with whitespace normalized, for duplicate detection."""
+    return hashlib.blake2b(" ".join(text.split()).encode(), digest_size=8).digest()
+
+def header_footer_band(lines):
+    """
+    Returns the indices of the lines in a page's header and footer band. Pages
+    too short to hold both bands only count their first and last line.
+    """
+    size = HEADER_FOOTER_LINES if len(lines) > 2 * HEADER_FOOTER_LINES else 1
+    return set(range(min(size, len(lines)))) | set(range(max(0, len(lines) - size), len(lines)))
+
+def find_running_lines(pages):
+    """
+    Returns the digests of header/footer band lines that recur on at least
+    HEADER_FOOTER_MIN_PAGES of the given pages (each a list of lines).
+    """
+    pages_by_digest = {}
+    for page_index, lines in enumerate(pages):
+        for line_index in header_footer_band(lines):
+            line = lines[line_index]
+            if len(line.strip()) >= DEDUP_MIN_CHARS:
+                pages_by_digest.setdefault(text_digest(line), set()).add(page_index)
+    return {digest for digest, seen in pages_by_digest.items() if len(seen) >= HEADER_FOOTER_MIN_PAGES}
+
+@st.cache_resource
+def get_pdfium_lock():
+    """
+    Returns the lock guarding all pdfium calls in this process. pdfium is not
+    thread-safe even across documents, and sessions extract concurrently.
+    """
+    return threading.Lock()
+
+def extract_pages_with_pdfium(pdf_bytes, pdfium_lock):
+    """
+    Extracts the text of every PDF page with the native pdfium backend.
+    Only pdfium's text page API is used; page objects are never iterated.
+    """
+    with pdfium_lock:
+        return read_pdfium_pages(pdf_bytes)
+
+def read_pdfium_pages(pdf_bytes):
+    """Reads every page's text with pdfium; the caller holds the pdfium lock."""
+    pdf = pdfium.PdfDocument(pdf_bytes)
     try:
-        reader = PdfReader(pdf_file)
+        results = []
+        for index in range(len(pdf)):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            try:
+                # get_text_bounded reads pdfium's text objects within the page box, so
+                # path and fill operators in graphics-heavy streams are never walked
+                # from Python. pdfium separates lines with CRLF; normalize to match
+                # PyPDF2 output
+                text = textpage.get_text_bounded().replace("\r\n", "\n")
+                results.append((text, None))
+            finally:
+                textpage.close()
+                page.close()
+        return results
+    finally:
+        pdf.close()
+
+def extract_pages_with_pypdf2(pdf_bytes):
+    """Extracts the text of every PDF page with PyPDF2, decoding pages in parallel."""
+    page_count = len(PdfReader(io.BytesIO(pdf_bytes)).pages)
+
+    # PdfReader seeks on its stream while resolving objects, so every worker
+    # thread opens its own reader over the shared bytes
+    worker_state = threading.local()
+
+    def extract_page(index):
+        try:
+            if not hasattr(worker_state, "reader"):
+                worker_state.reader = PdfReader(io.BytesIO(pdf_bytes))
+            return worker_state.reader.pages[index].extract_text() or "", None
+        except Exception as e:
+            return "", e
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(extract_page, range(page_count)))
+
+def extract_text_from_pdf(pdf_file, pdfium_lock):
+    """
+    Extracts text from all pages of a PDF file.
+    Returns (text, messages), where messages are (level, message) pairs for the
+    caller to show; this runs on worker threads, so it never calls Streamlit.
+    The caller passes in the pdfium lock from get_pdfium_lock for the same reason.
+    """
+    messages = []
+    try:
+        pdf_bytes = pdf_file.getvalue()
+        try:
+            results = extract_pages_with_pdfium(pdf_bytes, pdfium_lock)
+        except Exception as e:
+            messages.append(("warning", f"pdfium could not read PDF {pdf_file.name} ({e}), falling back to PyPDF2."))
+            results = extract_pages_with_pypdf2(pdf_bytes)
+
+        page_lines = {}
+        for i, (text, error) in enumerate(results):
+            if error is not None:
+                messages.append(("warning", f"Error reading page {i+1} of PDF {pdf_file.name}: {error}"))
+            elif text.strip():
+                page_lines[i] = text.split("\n")
+        running_lines = find_running_lines(list(page_lines.values()))
+
         text_parts = []
-        for i, page in enumerate(reader.pages):
-            text = page.extract_text() or ""
-            if text.strip():
-                text_parts.append(f"[Page {i+1}]\n{text}")
-        
-        st.info(f"Successfully extracted {len(text_parts)} pages from PDF: {pdf_file.name}")
-        return "\n\n".join(text_parts)
+        first_page_by_digest = {}
+        kept_running_lines = set()
+        dropped_lines = 0
+        for i, lines in page_lines.items():
+            # A page identical to an earlier one is kept only as a reference to it
+            digest = text_digest(results[i][0])
+            if digest in first_page_by_digest:
+                text_parts.append(f"[Page {i+1}]\n(Same text as page {first_page_by_digest[digest]})")
+                continue
+            first_page_by_digest[digest] = i + 1
+
+            band = header_footer_band(lines)
+            kept = []
+            for line_index, line in enumerate(lines):
+                if line_index in band and len(line.strip()) >= DEDUP_MIN_CHARS:
+                    line_digest = text_digest(line)
+                    if line_digest in running_lines:
+                        if line_digest in kept_running_lines:
+                            dropped_lines += 1
+                            continue
+                        kept_running_lines.add(line_digest)
+                kept.append(line)
+            page_text = "\n".join(kept)
+            if page_text.strip():
+                text_parts.append(f"[Page {i+1}]\n{page_text}")
+            else:
+                text_parts.append(f"[Page {i+1}]\n(Only repeated headers and footers)")
+
+        messages.append(("info", f"Successfully extracted {len(text_parts)} pages from PDF: {pdf_file.name}"))
+        if dropped_lines:
+            messages.append(("info", f"Removed {dropped_lines} repeated header and footer lines from PDF: {pdf_file.name}"))
+        return "\n\n".join(text_parts), messages
     except Exception as e:
-        st.error(f"Error reading PDF {pdf_file.name}: {e}")
-        return ""
+        messages.append(("error", f"Error reading PDF {pdf_file.name}: {e}"))
+        return "", messages
+
+# Text-bearing run content of a paragraph, in document order. Only direct runs and
+# hyperlink runs are matched, so text boxes nested in a run are not read twice.
+DOCX_RUN_TEXT_XPATH = (
+    "./w:r/w:t | ./w:r/w:tab | ./w:r/w:br"
+    " | ./w:hyperlink/w:r/w:t | ./w:hyperlink/w:r/w:tab | ./w:hyperlink/w:r/w:br"
+)
+# Word stores a VML copy of every text box under mc:Fallback next to the
+# mc:Choice drawing; paragraphs in that copy would repeat the text box text.
+DOCX_BODY_PARAGRAPHS = etree.XPath(
+    ".//w:p[not(ancestor::mc:Fallback)]",
+    namespaces={"w": nsmap["w"], "mc": "http://schemas.openxmlformats.org/markup-compatibility/2006"},
+)
+DOCX_TEXT_TAG = qn("w:t")
+DOCX_TAB_TAG = qn("w:tab")
 
 def extract_text_from_docx(docx_file):
-    """Extracts text from all paragraphs of a DOCX file."""
+    """
+    Extracts text from all paragraphs of a DOCX file, including those in tables.
+    Returns (text, messages) like extract_text_from_pdf.
+    """
+    messages = []
     try:
         doc = Document(docx_file)
-        # Extract text from paragraphs
+        # Walk the body XML once instead of building python-docx wrapper objects.
+        # Table cells hold ordinary w:p elements, so this also covers tables, in
+        # document order.
         text_parts = []
-        for para in doc.paragraphs:
-            if para.text.strip():
-                text_parts.append(para.text)
+        previous_paragraph = None
+        previous_digest = None
+        repeated_paragraphs = 0
+        for paragraph in DOCX_BODY_PARAGRAPHS(doc.element.body):
+            pieces = []
+            for node in paragraph.xpath(DOCX_RUN_TEXT_XPATH):
+                if node.tag == DOCX_TEXT_TAG:
+                    pieces.append(node.text or "")
+                elif node.tag == DOCX_TAB_TAG:
+                    pieces.append("\t")
+                else:
+                    pieces.append("\n")
+            text = "".join(pieces)
+            if not text.strip():
+                continue
+            # Only a paragraph identical to its immediate sibling in the same body or
+            # cell is dropped; the same text elsewhere (another table row, a later
+            # clause) is real content
+            digest = text_digest(text)
+            if (digest == previous_digest
+                    and paragraph.getprevious() is previous_paragraph
+                    and len(text.strip()) >= DEDUP_MIN_CHARS):
+                repeated_paragraphs += 1
+                continue
+            previous_paragraph = paragraph
+            previous_digest = digest
+            text_parts.append(text)
         
-        # Also extract text from tables
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    if cell.text.strip():
-                        text_parts.append(cell.text)
-        
-        st.info(f"Successfully extracted {len(text_parts)} text elements from DOCX: {docx_file.name}")
-        return "\n\n".join(text_parts)
+        messages.append(("info", f"Successfully extracted {len(text_parts)} text elements from DOCX: {docx_file.name}"))
+        if repeated_paragraphs:
+            messages.append(("info", f"Removed {repeated_paragraphs} repeated paragraphs from DOCX: {docx_file.name}"))
+        return "\n\n".join(text_parts), messages
     except Exception as e:
-        st.error(f"Error reading DOCX {docx_file.name}: {e}")
-        return ""
+        messages.append(("error", f"Error reading DOCX {docx_file.name}: {e}"))
+        return "", messages
 
 # ========== STEP 3: Create Cached Context ==========
 
+def to_named_stream(file_bytes, name):
+    """Wraps file bytes in an in-memory stream that carries the original file name."""
+    stream = io.BytesIO(file_bytes)
+    stream.name = name
+    return stream
+
+async def extract_uploads(pdf_bytes, pdf_name, docx_bytes, docx_name, pdfium_lock):
+    """
+    Extracts the PDF and DOCX files concurrently on worker threads.
+    Results come back in upload order, PDF first, then DOCX, as (text, messages) pairs.
+    """
+    jobs = []
+    if pdf_bytes is not None:
+        jobs.append(asyncio.to_thread(extract_text_from_pdf, to_named_stream(pdf_bytes, pdf_name), pdfium_lock))
+    if docx_bytes is not None:
+        jobs.append(asyncio.to_thread(extract_text_from_docx, to_named_stream(docx_bytes, docx_name)))
+    return await asyncio.gather(*jobs)
+
+# Extraction results are cached by file content, so Streamlit reruns (chat input,
+# button clicks, language toggles) do not re-extract unchanged uploads.
+@st.cache_data(show_spinner=False, max_entries=8)
+def extract_uploads_cached(pdf_bytes, pdf_name, docx_bytes, docx_name):
+    """Cached wrapper around extract_uploads, keyed by the files' bytes."""
+    return asyncio.run(extract_uploads(pdf_bytes, pdf_name, docx_bytes, docx_name, get_pdfium_lock()))
+
 def process_document_content(pdf_file=None, docx_file=None):
     """
     Extracts text from specified PDF and/or DOCX files and returns the combined content.
     """
-    combined_content = []
-
     if pdf_file is not None:
         st.info(f"Extracting PDF content from: {pdf_file.name}")
-        pdf_text = extract_text_from_pdf(pdf_file)
-        if pdf_text.strip():
-            combined_content.append(pdf_text)
-
     if docx_file is not None:
         st.info(f"Extracting DOCX content from: {docx_file.name}")
-        docx_text = extract_text_from_docx(docx_file)
-        if docx_text.strip():
-            combined_content.append(docx_text)
+
+    extracted = extract_uploads_cached(
+        pdf_file.getvalue() if pdf_file is not None else None,
+        pdf_file.name if pdf_file is not None else None,
+        docx_file.getvalue() if docx_file is not None else None,
+        docx_file.name if docx_file is not None else None,
+    )
+
+    # The workers only collect their messages; they are shown here, on the script thread
+    combined_content = []
+    for text, messages in extracted:
+        for level, message in messages:
+            getattr(st, level)(message)
+        if text.strip():
+            combined_content.append(text)
 
     final_content_string = "\n\n--- End of Document Section ---\n\n".join(combined_content)
 
@@ -89,12 +397,260 @@ def process_document_content(pdf_file=None, docx_file=None):
     st.info(f"Total extracted content length: {len(final_content_string)} characters.")
     return final_content_string
 
-# ========== STEP 4: Chat Interface with Streamlit ==========
+class ContextCacheRegistry:
+    """
+    Process-wide bookkeeping for Gemini context caches.
+    Maps cache keys to cache names in an on-disk shelve index, and keeps caches
+    alive in the background for as long as chats keep using them.
+    """
+
+    def __init__(self, index_path):
+        self._index_path = index_path
+        self._lock = threading.Lock()
+        self._last_used = {}
+
+    def lookup(self, key):
+        """Returns the cache name stored for key, or None."""
+        with self._lock, shelve.open(self._index_path) as index:
+            return index.get(key)
+
+    def remember(self, key, cache_name):
+        """Stores the cache name for key in the on-disk index."""
+        with self._lock, shelve.open(self._index_path) as index:
+            index[key] = cache_name
 
-def chatbot_interface(document_content, language="English"):
+    def touch(self, cache_name):
+        """Marks a cache as in use, starting its keep-warm thread if none is running."""
+        with self._lock:
+            is_new = cache_name not in self._last_used
+            self._last_used[cache_name] = time.monotonic()
+        if is_new:
+            threading.Thread(target=self._keep_warm, args=(cache_name,), daemon=True).start()
+
+    def _keep_warm(self, cache_name):
+        """Renews the cache TTL until it goes a full refresh interval without use."""
+        try:
+            while True:
+                time.sleep(CACHE_REFRESH_INTERVAL.total_seconds())
+                with self._lock:
+                    idle = time.monotonic() - self._last_used[cache_name]
+                if idle >= CACHE_REFRESH_INTERVAL.total_seconds():
+                    return
+                caching.CachedContent.get(cache_name).update(ttl=CACHE_TTL)
+        except Exception:
+            # The cache expired or was deleted, so there is nothing left to renew
+            return
+        finally:
+            with self._lock:
+                self._last_used.pop(cache_name, None)
+
+@st.cache_resource
+def get_context_cache_registry():
+    """Returns the registry shared by all sessions and reruns of this process."""
+    return ContextCacheRegistry(CACHE_INDEX_PATH)
+
+@st.cache_resource
+def get_base_model():
+    """Returns a plain GenerativeModel, used for token counting."""
+    return genai.GenerativeModel(MODEL_RESOURCE_NAME)
+
+def create_cached_context(prompt_hash, system_prompt):
+    """
+    Returns Gemini's context cache for the system prompt (which embeds the document),
+    reusing a live cache from the on-disk index before uploading a new one.
+    Returns None when the prompt is below the minimum cacheable size.
+    """
+    registry = get_context_cache_registry()
+    # Caches are model-specific, so the model name is part of the key. The
+    # prompt hash covers the template as well as the document, so a changed
+    # template never reuses a cache rendered from the old one
+    index_key = f"{MODEL_RESOURCE_NAME}/{prompt_hash}"
+
+    cache_name = registry.lookup(index_key)
+    if cache_name:
+        try:
+            cache = caching.CachedContent.get(cache_name)
+            registry.touch(cache.name)
+            return cache
+        except (google_exceptions.NotFound, google_exceptions.PermissionDenied):
+            # Expired or deleted on the server, so upload it again
+            pass
+
+    token_count = get_base_model().count_tokens(system_prompt).total_tokens
+    if token_count < CACHE_MIN_TOKENS.get(MODEL_RESOURCE_NAME, DEFAULT_CACHE_MIN_TOKENS):
+        return None
+
+    try:
+        cache = caching.CachedContent.create(
+            model=MODEL_RESOURCE_NAME,
+            display_name=prompt_hash,
+            system_instruction=system_prompt,
+            ttl=CACHE_TTL,
+        )
+    except google_exceptions.GoogleAPIError as e:
+        # Caching is only an optimization, so any refusal falls back to the inline prompt
+        st.warning(f"Context caching unavailable, sending the document inline: {e}")
+        return None
+    registry.remember(index_key, cache.name)
+    registry.touch(cache.name)
+    return cache
+
+# The model and its context cache are shared by every session whose rendered
+# system prompt is the same, whatever its UI language. The entry expires a little before
+# the Gemini cache does, so an expired cache is never handed out.
+@st.cache_resource(show_spinner=False, ttl=CACHE_TTL - datetime.timedelta(minutes=5))
+def get_document_model(prompt_hash, _system_prompt):
+    """
+    Returns a GenerativeModel bound to the document's context cache, or a model
+    carrying the prompt inline when the document is too small to cache.
+    """
+    cache = create_cached_context(prompt_hash, _system_prompt)
+    if cache is not None:
+        return genai.GenerativeModel.from_cached_content(cache)
+    return genai.GenerativeModel(MODEL_RESOURCE_NAME, system_instruction=_system_prompt)
+
+def rebuild_document_chat(prompt_hash):
+    """
+    Replaces the session chat after its context cache expired on the server.
+    The model is rebuilt from the same system prompt and the history is kept.
+    """
+    system_prompt = st.session_state["system_prompt"]
+    # Only this prompt's entry is evicted; other documents' models stay cached
+    get_document_model.clear(prompt_hash, system_prompt)
+    model = get_document_model(prompt_hash, system_prompt)
+    st.session_state["chat"] = model.start_chat(history=st.session_state["chat"].history)
+
+def reset_chat_session():
+    """
+    Drops the chat and its history. The document's system prompt, model and
+    context cache are kept, so the next chat starts without a new prefill.
+    """
+    st.session_state.pop("messages", None)
+    st.session_state.pop("chat", None)
+
+# ========== STEP 4: Retrieval Index ==========
+
+def split_into_chunks(document_content, chunk_size=CHUNK_SIZE):
+    """
+    Splits text into chunks of at most chunk_size characters, breaking at
+    sentence and paragraph boundaries wherever possible.
+    """
+    chunks = []
+    current = []
+    current_length = 0
+    for sentence in SENTENCE_BOUNDARY.split(document_content):
+        sentence = sentence.strip()
+        # Sentences longer than a whole chunk are hard-split
+        for start in range(0, len(sentence), chunk_size):
+            piece = sentence[start:start + chunk_size]
+            if current and current_length + len(piece) + 1 > chunk_size:
+                chunks.append(" ".join(current))
+                current = []
+                current_length = 0
+            current.append(piece)
+            current_length += len(piece) + 1
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def embed_texts(texts, task_type):
+    """Embeds texts in batches and returns an (N, D) float32 matrix of unit vectors."""
+    vectors = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        result = genai.embed_content(
+            model=EMBEDDING_MODEL,
+            content=texts[start:start + EMBED_BATCH_SIZE],
+            task_type=task_type,
+        )
+        vectors.extend(result["embedding"])
+    matrix = np.asarray(vectors, dtype=np.float32)
+    # Normalized rows turn the dot product into cosine similarity
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return matrix
+
+# Streamlit re-executes this module on every rerun, so the kernel is built once
+# per process here instead of at module level, where numba would make a new
+# dispatcher and reload the compiled code on each rerun.
+@st.cache_resource
+def get_int8_scorer():
+    """Returns score_int8(quantized, scales, query_quantized), compiled with numba when available."""
+    if numba is not None:
+        @numba.njit(parallel=True, fastmath=True, cache=True)
+        def score_int8(quantized, scales, query_quantized):
+            """Scores every int8 row against the int8 query, rows spread across cores."""
+            scores = np.empty(quantized.shape[0], dtype=np.float32)
+            for i in numba.prange(quantized.shape[0]):
+                acc = 0
+                for j in range(quantized.shape[1]):
+                    acc += np.int32(quantized[i, j]) * np.int32(query_quantized[j])
+                scores[i] = acc * scales[i]
+            return scores
+    else:
+        def score_int8(quantized, scales, query_quantized):
+            """Scores every int8 row against the int8 query."""
+            return np.matmul(quantized, query_quantized, dtype=np.int32) * scales
+    return score_int8
+
+def quantize_int8(matrix):
+    """Quantizes each row to int8 with its own scale, returning (quantized, scales)."""
+    scales = np.maximum(np.abs(matrix).max(axis=1, keepdims=True), 1e-12) / 127
+    quantized = np.round(matrix / scales).astype(np.int8)
+    return quantized, scales.ravel().astype(np.float32)
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def build_retrieval_index(cache_hash, _document_content):
+    """
+    Chunks and embeds the document once per document hash.
+    Documents with more than RERANK_CANDIDATES chunks also get an int8 copy of
+    the embeddings, scanned for every question; the float32 copy is then only
+    read for the few candidates that get reranked.
+    """
+    chunks = split_into_chunks(_document_content)
+    vectors = embed_texts(chunks, "retrieval_document")
+    retrieval_index = {"chunks": chunks, "vectors": vectors}
+    if len(chunks) > RERANK_CANDIDATES:
+        retrieval_index["quantized"], retrieval_index["scales"] = quantize_int8(vectors)
+    return retrieval_index
+
+def retrieve_chunks(retrieval_index, question, top_k=RETRIEVAL_TOP_K):
+    """Returns the top_k chunks most similar to the question, best match first."""
+    chunks = retrieval_index["chunks"]
+    if not chunks:
+        return []
+    query_vector = embed_texts([question], "retrieval_query")[0]
+
+    if "quantized" in retrieval_index and len(chunks) > max(RERANK_CANDIDATES, top_k):
+        # First pass: approximate scores from the int8 embeddings. The query's own
+        # scale is the same for every row, so it does not affect the ranking.
+        query_quantized, _ = quantize_int8(query_vector[np.newaxis, :])
+        approx_scores = get_int8_scorer()(
+            retrieval_index["quantized"], retrieval_index["scales"], query_quantized[0]
+        )
+        candidate_count = max(RERANK_CANDIDATES, top_k)
+        candidates = np.argpartition(-approx_scores, candidate_count - 1)[:candidate_count]
+    else:
+        # Small documents would keep every chunk as a candidate anyway
+        candidates = np.arange(len(chunks))
+
+    # Second pass: exact float32 scores for the candidates only
+    scores = retrieval_index["vectors"][candidates] @ query_vector
+    top_k = min(top_k, len(candidates))
+    top = np.argpartition(-scores, top_k - 1)[:top_k]
+    top = top[np.argsort(-scores[top])]
+    return [chunks[candidates[i]] for i in top]
+
+@st.cache_resource(show_spinner=False)
+def get_retrieval_model():
+    """Returns a GenerativeModel whose system prompt holds the answering rules only."""
+    return genai.GenerativeModel(MODEL_RESOURCE_NAME, system_instruction=RETRIEVAL_SYSTEM_PROMPT)
+
+# ========== STEP 5: Chat Interface with Streamlit ==========
+
+def chatbot_interface(document_content, language="English", use_retrieval=False):
     """
     Initializes a GenerativeModel and provides a chat interface using Streamlit.
-    The document content is used as context for the model.
+    The document content is used as context for the model, either whole or, with
+    use_retrieval, as the most relevant chunks sent along with each question.
     Supports both English and Marathi languages.
     """
     if not document_content:
@@ -103,83 +659,42 @@ def chatbot_interface(document_content, language="English"):
         return
 
     try:
-        # Use the most capable model available
-        model = genai.GenerativeModel(MODEL_RESOURCE_NAME)
-        
-        # Display ready message in the selected language
-        ready_msg = "✅ चॅटबॉट तयार आहे. आपल्या प्रश्नांची उत्तरे अपलोड केलेल्या दस्तऐवजांच्या आधारे दिली जातील." if language == "मराठी" else "✅ Chatbot is ready. Your questions will be answered based on the uploaded documents."
-        st.info(ready_msg)
+        # A new document invalidates the chat built for the old one
+        cache_hash = hashlib.blake2b(document_content.encode()).hexdigest()
+        if st.session_state.get("cache_hash") != cache_hash:
+            reset_chat_session()
+            st.session_state.pop("system_prompt", None)
+            st.session_state.pop("prompt_hash", None)
+            st.session_state["cache_hash"] = cache_hash
+
+        if use_retrieval:
+            indexing_msg = "दस्तऐवज अनुक्रमित करत आहे..." if language == "मराठी" else "Indexing documents..."
+            with st.spinner(indexing_msg):
+                retrieval_index = build_retrieval_index(cache_hash, document_content)
 
-        # Display document content length for debugging
-        length_msg = f"दस्तऐवज सामग्री लांबी: {len(document_content)} वर्ण" if language == "मराठी" else f"Document content length: {len(document_content)} characters"
-        st.info(length_msg)
-        
         # Initialize chat session with document content
         if "chat" not in st.session_state:
-            # Add system instructions as a user message in the appropriate language
-            if language == "मराठी":
-                system_message = (
-                    "तुम्ही एक मदतगार सहाय्यक आहात. "
-                    "तुमचे प्राथमिक कार्य प्रदान केलेल्या दस्तऐवज संदर्भावर आधारित वापरकर्त्याच्या प्रश्नांची उत्तरे देणे आहे. "
-                    "जर प्रश्नाचे उत्तर प्रदान केलेल्या दस्तऐवजांमध्ये आढळले नाही, तर तुम्ही स्पष्टपणे सांगा: 'ही माहिती प्रदान केलेल्या दस्तऐवजांमध्ये उपलब्ध नाही.' "
-                    "जर माहिती दस्तऐवजांमध्ये नसेल तर सामान्य ज्ञानातून उत्तर देण्याचा प्रयत्न करू नका. "
-                    "तुम्ही मराठी भाषेत उत्तर द्या."
-                )
-                
-                document_message = (
-                    "दस्तऐवज सामग्री सुरू\n\n"
-                    f"{document_content}\n\n"
-                    "दस्तऐवज सामग्री समाप्त\n\n"
-                    "कृपया माझ्या प्रश्नांची उत्तरे देण्यासाठी फक्त दस्तऐवज सामग्री सुरू आणि दस्तऐवज सामग्री समाप्त यांच्या दरम्यान असलेली माहिती वापरा. "
-                    "जर माहिती दस्तऐवजात नसेल तर तसे सांगा."
-                )
-                
-                model_response1 = "मी माझी भूमिका समजून घेतली आहे. मी फक्त दस्तऐवज सामग्रीवर आधारित प्रश्नांची उत्तरे देईन."
-                model_response2 = "मला दस्तऐवज सामग्री मिळाली आहे आणि मी तुमच्या प्रश्नांची उत्तरे देण्यासाठी त्याचा वापर करेन."
+            if use_retrieval:
+                model = get_retrieval_model()
             else:
-                system_message = (
-                    "You are a helpful assistant. "
-                    "Your primary function is to answer user questions strictly based on the "
-                    "information contained in the provided document context. "
-                    "If the answer to a question cannot be found within the provided documents, "
-                    "you MUST explicitly state: 'The information is not available in the provided documents.' "
-                    "Do not attempt to answer from general knowledge if the information is not in the documents."
-                )
-                
-                document_message = (
-                    "DOCUMENT CONTENT START\n\n"
-                    f"{document_content}\n\n"
-                    "DOCUMENT CONTENT END\n\n"
-                    "Please use ONLY the information between DOCUMENT CONTENT START and DOCUMENT CONTENT END "
-                    "to answer my questions. If the information is not in the document, say so."
-                )
-                
-                model_response1 = "I understand my role. I'll answer questions based strictly on the document content."
-                model_response2 = "I've received the document content and will use it to answer your questions."
-            
-            # Start chat with document content and system instructions
-            chat = model.start_chat(
-                history=[
-                    {
-                        "role": "user",
-                        "parts": [{"text": system_message}]
-                    },
-                    {
-                        "role": "model",
-                        "parts": [{"text": model_response1}]
-                    },
-                    {
-                        "role": "user",
-                        "parts": [{"text": document_message}]
-                    },
-                    {
-                        "role": "model",
-                        "parts": [{"text": model_response2}]
-                    }
-                ]
-            )
-            st.session_state["chat"] = chat
-        
+                # Render the prompt once per session and reuse it verbatim so the prefix never changes
+                if "system_prompt" not in st.session_state:
+                    st.session_state["system_prompt"] = SYSTEM_PROMPT_TEMPLATE.format(
+                        document_content=document_content
+                    )
+                    st.session_state["prompt_hash"] = hashlib.blake2b(
+                        st.session_state["system_prompt"].encode()
+                    ).hexdigest()
+                system_prompt = st.session_state["system_prompt"]
+
+                # Prefer the explicit context cache so the document is prefilled only once
+                model = get_document_model(st.session_state["prompt_hash"], system_prompt)
+            st.session_state["chat"] = model.start_chat(history=[])
+
+        # Display ready message in the selected language
+        ready_msg = "✅ चॅटबॉट तयार आहे. आपल्या प्रश्नांची उत्तरे अपलोड केलेल्या दस्तऐवजांच्या आधारे दिली जातील." if language == "मराठी" else "✅ Chatbot is ready. Your questions will be answered based on the uploaded documents."
+        st.info(ready_msg)
+
         # Initialize messages if not already done
         if "messages" not in st.session_state:
             st.session_state["messages"] = []
@@ -200,11 +715,51 @@ def chatbot_interface(document_content, language="English"):
                 message_placeholder = st.empty()
                 full_response = ""
                 try:
-                    response = st.session_state["chat"].send_message(prompt, stream=True)
+                    chat = st.session_state["chat"]
+                    if chat.model.cached_content:
+                        # Keeps the context cache warm while this document is in use
+                        get_context_cache_registry().touch(chat.model.cached_content)
+                    # The answer language is chosen per turn, after the cached prefix
+                    if use_retrieval:
+                        excerpts = "\n\n---\n\n".join(retrieve_chunks(retrieval_index, prompt))
+                        message = RETRIEVAL_QUESTION_TEMPLATE.format(excerpts=excerpts, question=prompt)
+                        message = f"{message}\n\n{LANGUAGE_DIRECTIVE[language]}"
+                        # Excerpts go out with this turn only; the history is not extended
+                        # here, so later turns do not re-send old excerpts
+                        response = chat.model.generate_content(
+                            chat.history + [{"role": "user", "parts": [{"text": message}]}],
+                            stream=True,
+                        )
+                    else:
+                        message = f"{prompt}\n\n{LANGUAGE_DIRECTIVE[language]}"
+                        try:
+                            response = chat.send_message(message, stream=True)
+                        except (google_exceptions.NotFound, google_exceptions.PermissionDenied):
+                            if not chat.model.cached_content:
+                                raise
+                            # The context cache expired while the session sat idle
+                            rebuild_document_chat(st.session_state["prompt_hash"])
+                            chat = st.session_state["chat"]
+                            response = chat.send_message(message, stream=True)
+                    # Every markdown() call is a frontend round trip, so redraw only
+                    # after enough time or text has accumulated
+                    last_flush = time.monotonic()
+                    flushed_length = 0
                     for chunk in response:
                         full_response += (chunk.text if chunk.text else "")
-                        message_placeholder.markdown(full_response + "▌")
+                        now = time.monotonic()
+                        if (now - last_flush > STREAM_FLUSH_SECONDS
+                                or len(full_response) - flushed_length > STREAM_FLUSH_CHARS):
+                            message_placeholder.markdown(full_response + "▌")
+                            last_flush = now
+                            flushed_length = len(full_response)
                     message_placeholder.markdown(full_response)
+                    if use_retrieval:
+                        # Keep the retrieval history as bare question and answer pairs
+                        chat.history = chat.history + [
+                            {"role": "user", "parts": [{"text": prompt}]},
+                            {"role": "model", "parts": [{"text": full_response}]},
+                        ]
                     st.session_state["messages"].append({"role": "assistant", "content": full_response})
                 except Exception as e:
                     error_msg = f"संदेश निर्मितीदरम्यान त्रुटी: {e}" if language == "मराठी" else f"Error during message generation: {e}"
@@ -214,7 +769,7 @@ def chatbot_interface(document_content, language="English"):
         error_msg = f"मॉडेल आरंभ करताना त्रुटी: {e}" if language == "मराठी" else f"Error initializing model: {e}"
         st.error(error_msg)
 
-# ========== STEP 5: Streamlit App ==========
+# ========== STEP 6: Streamlit App ==========
 
 def main():
     # Language selection
@@ -222,6 +777,12 @@ def main():
         "भाषा निवडा / Select Language",
         ["मराठी", "English"]
     )
+
+    # Retrieval mode sends only the relevant document chunks with each question
+    use_retrieval = st.sidebar.checkbox(
+        "फक्त संबंधित उतारे पाठवा / Send only relevant excerpts",
+        help="Recommended for very large documents."
+    )
     
     if language == "मराठी":
         st.title("जेमिनी सह दस्तऐवज चॅटबॉट")
@@ -268,11 +829,13 @@ def main():
     else:
         if language != st.session_state["language"]:
             st.session_state["language"] = language
-            # Clear chat when language changes
-            if "messages" in st.session_state:
-                st.session_state.pop("messages")
-            if "chat" in st.session_state:
-                st.session_state.pop("chat")
+            # Start a new chat in the new language; it reuses the same context cache
+            reset_chat_session()
+
+    # The whole-document and retrieval chats use different prompts, so switching needs a new chat
+    if st.session_state.get("use_retrieval", use_retrieval) != use_retrieval:
+        reset_chat_session()
+    st.session_state["use_retrieval"] = use_retrieval
     
     # Use the appropriate language for UI elements
     if st.session_state["language"] == "मराठी":
@@ -317,16 +880,13 @@ def main():
                         st.write(file_msg.format("DOCX", uploaded_docx.name))
                 
                 # Pass the selected language to the chatbot interface
-                chatbot_interface(document_content, st.session_state["language"])
+                chatbot_interface(document_content, st.session_state["language"], use_retrieval)
 
                 # Optional: Add a button to reset the chat
                 if st.button(reset_btn):
                     try:
                         # Clear session state
-                        if "messages" in st.session_state:
-                            st.session_state.pop("messages")
-                        if "chat" in st.session_state:
-                            st.session_state.pop("chat")
+                        reset_chat_session()
                         st.info(reset_msg)
                         # Force a rerun to clear the chat history
                         st.rerun()